@@ -1,14 +1,101 @@
 import os
+import asyncio
+import httpx
 import requests
 import json
-import random
+import zlib
+import hashlib
+import tempfile
+import logging
+import threading
+import string
+import re
+from functools import lru_cache
+from operator import itemgetter
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import semantic_cache
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
 # Get API key from environment
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_API_URL = "https://api.deepseek.com/chat/completions"
+DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+
+# Retry policy for DeepSeek API calls: up to 5 retries with exponential
+# backoff (factor 2.0) on rate limiting, server errors and connection failures
+RETRY_TOTAL = 5
+RETRY_BACKOFF = 2.0
+RETRY_INITIAL_DELAY = 1.0
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Shared HTTP session so every call reuses pooled keep-alive connections
+# to the DeepSeek API instead of doing a fresh TCP + TLS handshake.
+# requests.Session is safe to share across Flask request threads.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["POST"])
+    )
+))
+
+# Local cache of generated messages, keyed by a hash of the prompt version
+# and profile data. Bump PROMPT_TEMPLATE_VERSION whenever the prompt changes
+# so stale messages are not served.
+PROMPT_TEMPLATE_VERSION = "4"
+_cache_path = os.getenv("MESSAGE_CACHE_PATH", "msg_cache.json")
+_cache_lock = threading.Lock()
+
+def _load_cache():
+    """Load the message cache from disk, starting empty if missing or corrupt"""
+    try:
+        with open(_cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+_message_cache = _load_cache()
+
+def _cache_key(profile_data):
+    """SHA-256 key over the prompt version and canonicalised profile data"""
+    raw = PROMPT_TEMPLATE_VERSION + json.dumps(profile_data, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def _cache_store(entries):
+    """Write-through new entries, replacing the cache file atomically"""
+    with _cache_lock:
+        # Pick up entries other processes have written since we loaded, so
+        # replacing the file doesn't drop them
+        for key, message in _load_cache().items():
+            _message_cache.setdefault(key, message)
+        _message_cache.update(entries)
+
+        # Unique temp file per write so concurrent writers never share one
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(_cache_path) or '.',
+            prefix=os.path.basename(_cache_path) + '.',
+            suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(_message_cache, f)
+            os.replace(tmp_path, _cache_path)
+        except OSError as e:
+            logger.warning(f"Could not persist message cache: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
 # Templates for fallback messages if API fails
 RECRUITER_FALLBACK = [
@@ -25,79 +112,371 @@ ALUMNI_FALLBACK = [
     "Your path from {school} to {current_role} at {company} is inspiring! Would you be open to connecting and sharing some career insights?"
 ]
 
-def generate_message(profile_data):
+def _compile(template):
+    """Pre-parse a format string into (literal, field_name) pairs"""
+    return [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+
+def _render(compiled, template_vars):
+    """Render a template produced by _compile"""
+    return ''.join(
+        literal + (str(template_vars[field]) if field else '')
+        for literal, field in compiled
+    )
+
+# Parse fallback templates once at import instead of on every format call
+_COMPILED_RECRUITER = [_compile(t) for t in RECRUITER_FALLBACK]
+_COMPILED_ALUMNI = [_compile(t) for t in ALUMNI_FALLBACK]
+_COMPILED_ALL = _COMPILED_RECRUITER + _COMPILED_ALUMNI
+_FALLBACK_TEMPLATES = {
+    "recruiter": _COMPILED_RECRUITER,
+    "alumni": _COMPILED_ALUMNI,
+    "generic": _COMPILED_ALL
+}
+
+# Profiles sent to the API per chat-completions call
+MAX_BATCH_SIZE = 20
+
+def _profile_id(profile_data, index):
     """
-    Generate targeted LinkedIn messages based on profile type (recruiter/alumni)
+    Key for a profile in batch results: its URL, or "#<index>" if it has none.
+    The "#" keeps index keys from colliding with URLs.
     """
-    if not DEEPSEEK_API_KEY:
-        print("Warning: No API key. Using fallback templates.")
-        return get_fallback_message(profile_data)
-    
-    try:
-        # Extract profile details with intelligent fallbacks
-        name = profile_data.get('name', 'there')
-        title = profile_data.get('title', 'professional').lower()
-        company = profile_data.get('company', 'your company')
-        school = profile_data.get('school', 'our alma mater')
-        industry = profile_data.get('industry', 'this field')
-        your_role = profile_data.get('your_role', 'aspiring professional')
-        
-        # Determine message type
-        is_recruiter = 'recruit' in title or 'talent' in title
-        is_alumni = 'school' in profile_data  # Assuming school is only present for alumni
+    url = profile_data.get('profileUrl')
+    return url if isinstance(url, str) and url else f"#{index}"
 
-        # Build AI prompt
-        prompt = f"""Create a LinkedIn connection message for {name} with these rules:
+# Prompt pieces are built once at import. The rules block must stay
+# byte-identical across calls and come first so DeepSeek's server-side prefix
+# cache hits; everything profile-specific goes after it.
+_RULES_PREFIX = """Create a LinkedIn connection message for each target profile below with these rules:
         - Max 2 sentences
         - Professional but approachable tone
         - No emojis or slang
         - Skip greetings/signatures
         
-        Target Profile: """
+        Return a JSON object mapping each profile ID to its message, e.g. {"<ID>": "<message>"}.
         
-        if is_recruiter:
-            prompt += f"""Recruiter at {company} in {industry}. 
+        Target Profiles:
+        """
+
+# Per-audience profile sections, keyed by the kind returned by _classify
+_KIND_TEMPLATES = {
+    "recruiter": """
+        ID: {profile_id}
+        Target Profile: Recruiter at {company} in {industry}. 
             Goal: Express interest in internship opportunities, highlight relevant skills ({your_role}), 
-            and request to stay connected."""
-        elif is_alumni:
-            prompt += f"""Alumni from {school} now working as {title} at {company}.
+            and request to stay connected.
+        Recipient name: {name}
+        """,
+    "alumni": """
+        ID: {profile_id}
+        Target Profile: Alumni from {school} now working as {title} at {company}.
             Goal: Establish common ground, express interest in their career journey, 
-            and request brief insights about transitioning from school to their role."""
-        else:
-            prompt += f"""Generic professional ({title} at {company}).
+            and request brief insights about transitioning from school to their role.
+        Recipient name: {name}
+        """,
+    "generic": """
+        ID: {profile_id}
+        Target Profile: Generic professional ({title} at {company}).
             Goal: Create connection based on shared industry interests ({industry}) 
-            and request knowledge sharing."""
+            and request knowledge sharing.
+        Recipient name: {name}
+        """
+}
+_COMPILED_KIND_TEMPLATES = {kind: _compile(t) for kind, t in _KIND_TEMPLATES.items()}
 
-        # API call remains the same...
-        # ... (keep existing API call structure)
+_RECRUITER_TITLE_RE = re.compile(r"recruit|talent")
+
+def _classify(profile_data):
+    """
+    Classify a profile once per request. Returns (title, kind) with the title
+    casefolded and kind one of "recruiter", "alumni" or "generic".
+    """
+    title = profile_data.get('title')
+    title = 'professional' if title is None else str(title)
+    title = title.casefold()
+    if _RECRUITER_TITLE_RE.search(title) is not None:
+        kind = "recruiter"
+    elif profile_data.get('school') is not None:  # Assuming school is only present for alumni
+        kind = "alumni"
+    else:
+        kind = "generic"
+    return title, kind
+
+def _present_fields(profile_data):
+    """Profile fields minus explicit nulls, so merged defaults apply to them too"""
+    return {k: v for k, v in profile_data.items() if v is not None}
+
+# Intelligent fallbacks for profile details missing from the prompt
+_PROMPT_DEFAULTS = {
+    'name': 'there',
+    'company': 'your company',
+    'school': 'our alma mater',
+    'industry': 'this field',
+    'your_role': 'aspiring professional'
+}
+
+def _describe_profile(profile_id, profile_data, classification):
+    """Build the profile-specific part of the prompt"""
+    title, kind = classification
+
+    # One merge fills every default (explicit nulls count as missing); the
+    # templates read the fields they need
+    template_vars = _PROMPT_DEFAULTS | _present_fields(profile_data)
+    template_vars['title'] = title
+    template_vars['profile_id'] = profile_id
+    return _render(_COMPILED_KIND_TEMPLATES[kind], template_vars)
+
+def _build_payload(chunk):
+    """Build the chat-completions payload for (profile_id, profile_data, classification) items"""
+    # Profiles are identified to the model by position in the chunk, not by
+    # URL, so IDs are always unique and short enough to be echoed back intact
+    prompt = "".join([_RULES_PREFIX] + [
+        _describe_profile(str(position), profile_data, classification)
+        for position, (_, profile_data, classification) in enumerate(chunk)
+    ])
+
+    return {
+        "model": DEEPSEEK_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "response_format": {"type": "json_object"},
+        "max_tokens": 4096,
+        "temperature": 0.7
+    }
+
+def _parse_result(result):
+    """Extract the {position: message} map from an API response body"""
+    usage = result.get('usage', {})
+    logger.info(
+        f"DeepSeek usage: prompt_cache_hit_tokens={usage.get('prompt_cache_hit_tokens')}, "
+        f"prompt_cache_miss_tokens={usage.get('prompt_cache_miss_tokens')}"
+    )
+
+    generated = json.loads(result['choices'][0]['message']['content'])
+    return generated if isinstance(generated, dict) else {}
+
+def _finish_chunk(chunk, generated):
+    """
+    Cache generated messages and fill in fallbacks for any that are missing.
+    generated maps chunk positions (as strings) to messages.
+    """
+    # With a single profile there is nothing to disambiguate, so accept the
+    # response's only message whatever key the model used for it
+    if len(chunk) == 1 and len(generated) == 1:
+        generated = {"0": next(iter(generated.values()))}
+
+    messages = {}
+    new_entries = {}
+    semantic_entries = []
+    for position, (pid, profile_data, classification) in enumerate(chunk):
+        message = generated.get(str(position))
+        if isinstance(message, str) and message.strip():
+            messages[pid] = message.strip()
+            new_entries[_cache_key(profile_data)] = messages[pid]
+            semantic_entries.append((profile_data, messages[pid]))
+        else:
+            messages[pid] = get_fallback_message(profile_data, classification)
+
+    if new_entries:
+        _cache_store(new_entries)
+    semantic_cache.store_many(semantic_entries)
+    return messages
+
+def _generate_chunk(chunk):
+    """
+    Generate messages for up to MAX_BATCH_SIZE (profile_id, profile_data,
+    classification) items in a single API call, falling back per profile on failure
+    """
+    generated = {}
+    try:
+        response = _session.post(
+            DEEPSEEK_API_URL,
+            json=_build_payload(chunk),
+            headers={"Authorization": f"Bearer {DEEPSEEK_API_KEY}"},
+            timeout=(3.05, 30)
+        )
+        response.raise_for_status()
+        generated = _parse_result(response.json())
 
     except Exception as e:
-        return get_fallback_message(profile_data)
+        logger.warning(f"Batch generation failed, using fallback templates: {e}")
 
-def get_fallback_message(profile_data):
-    """Improved fallback with audience-specific templates"""
-    is_recruiter = 'recruit' in profile_data.get('title', '').lower()
-    is_alumni = 'school' in profile_data
-    
+    return _finish_chunk(chunk, generated)
+
+async def _agen(chunk, client, sem):
+    """
+    Call the API for one chunk on the async client, retrying with backoff.
+    Returns the raw {position: message} map; caching and fallbacks are left
+    to the caller so no blocking work runs on the event loop.
+    """
+    generated = {}
+    async with sem:
+        for attempt in range(RETRY_TOTAL + 1):
+            try:
+                response = await client.post(
+                    DEEPSEEK_API_URL,
+                    json=_build_payload(chunk),
+                    headers={"Authorization": f"Bearer {DEEPSEEK_API_KEY}"}
+                )
+                if response.status_code in RETRY_STATUSES and attempt < RETRY_TOTAL:
+                    await asyncio.sleep(RETRY_INITIAL_DELAY * RETRY_BACKOFF ** attempt)
+                    continue
+                response.raise_for_status()
+                generated = _parse_result(response.json())
+                break
+            except httpx.TransportError as e:
+                if attempt < RETRY_TOTAL:
+                    await asyncio.sleep(RETRY_INITIAL_DELAY * RETRY_BACKOFF ** attempt)
+                    continue
+                logger.warning(f"Generation failed, using fallback templates: {e}")
+            except Exception as e:
+                logger.warning(f"Generation failed, using fallback templates: {e}")
+                break
+
+    return generated
+
+async def _agen_all(pending, max_concurrent):
+    """
+    Run one API call per profile, at most max_concurrent at a time. Returns
+    one {position: message} map per pending item, in order.
+    """
+    sem = asyncio.Semaphore(max_concurrent)
+    async with httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=max_concurrent, max_keepalive_connections=max_concurrent),
+        timeout=httpx.Timeout(60.0)
+    ) as client:
+        return await asyncio.gather(*(_agen([item], client, sem) for item in pending))
+
+def _split_cached(profiles):
+    """Return cached messages and the (profile_id, profile_data, classification) items still to generate"""
+    messages = {}
+    misses = []
+    seen = set()
+    for i, profile_data in enumerate(profiles):
+        pid = _profile_id(profile_data, i)
+        # Repeated URLs share one result, so only generate them once
+        if pid in seen:
+            continue
+        seen.add(pid)
+        cached = _message_cache.get(_cache_key(profile_data))
+        if cached is not None:
+            messages[pid] = cached
+        else:
+            misses.append((pid, profile_data))
+
+    # Exact misses may still match a near-identical profile (e.g. same role
+    # at the same company, different name) in the semantic cache
+    pending = []
+    similar = semantic_cache.lookup_many([profile_data for _, profile_data in misses])
+    for (pid, profile_data), cached in zip(misses, similar):
+        if cached is not None:
+            messages[pid] = cached
+        else:
+            pending.append((pid, profile_data, _classify(profile_data)))
+    return messages, pending
+
+def _all_fallback(profiles):
+    """Fallback messages for every profile, used when there is no API key"""
+    print("Warning: No API key. Using fallback templates.")
+    return {
+        _profile_id(profile_data, i): get_fallback_message(profile_data)
+        for i, profile_data in enumerate(profiles)
+    }
+
+def generate_messages_batch(profiles):
+    """
+    Generate targeted LinkedIn messages for several profiles, sending up to
+    MAX_BATCH_SIZE profiles per API call. Returns a dict mapping each
+    profile's URL (or "#<list index>", if it has no URL) to its message.
+    """
+    if not DEEPSEEK_API_KEY:
+        return _all_fallback(profiles)
+
+    messages, pending = _split_cached(profiles)
+
+    for start in range(0, len(pending), MAX_BATCH_SIZE):
+        messages.update(_generate_chunk(pending[start:start + MAX_BATCH_SIZE]))
+
+    return messages
+
+def generate_many(profiles, max_concurrent=10):
+    """
+    Like generate_messages_batch, but makes a separate API call per profile,
+    running up to max_concurrent calls at once. Use this when each profile
+    needs its own completion rather than sharing one batched response.
+    """
+    if not DEEPSEEK_API_KEY:
+        return _all_fallback(profiles)
+
+    messages, pending = _split_cached(profiles)
+
+    if pending:
+        results = asyncio.run(_agen_all(pending, max_concurrent))
+
+        # Re-key each single-profile response by its position in pending, then
+        # cache and fill fallbacks for everything at once, off the event loop
+        generated = {}
+        for position, result in enumerate(results):
+            if len(result) == 1:
+                generated[str(position)] = next(iter(result.values()))
+        messages.update(_finish_chunk(pending, generated))
+
+    return messages
+
+def generate_message(profile_data):
+    """
+    Generate targeted LinkedIn messages based on profile type (recruiter/alumni)
+    """
+    return generate_messages_batch([profile_data])[_profile_id(profile_data, 0)]
+
+@lru_cache(maxsize=4096)
+def _fallback_cached(name, title, company, school, industry, your_role,
+                     kind, seed):
+    """Render a fallback message; identical inputs always give the same message"""
     # Fill template variables
     template_vars = {
-        'name': profile_data.get('name', 'there'),
-        'title': profile_data.get('title', 'professional'),
-        'company': profile_data.get('company', 'your company'),
-        'school': profile_data.get('school', 'our shared alma mater'),
-        'industry': profile_data.get('industry', 'this field'),
-        'your_role': profile_data.get('your_role', 'aspiring professional'),
-        'current_role': profile_data.get('title', 'current position')
+        'name': name,
+        'title': 'professional' if title is None else title,
+        'company': company,
+        'school': school,
+        'industry': industry,
+        'your_role': your_role,
+        'current_role': 'current position' if title is None else title
     }
 
-    if is_recruiter:
-        template = random.choice(RECRUITER_FALLBACK)
-    elif is_alumni:
-        template = random.choice(ALUMNI_FALLBACK)
-    else:
-        template = random.choice(RECRUITER_FALLBACK + ALUMNI_FALLBACK)
+    templates = _FALLBACK_TEMPLATES[kind]
+    return _render(templates[seed % len(templates)], template_vars)
+
+# Fallback template values, in _fallback_cached's argument order. A missing
+# title stays None so _fallback_cached can pick a context-specific default.
+_FALLBACK_DEFAULTS = {
+    'name': 'there',
+    'title': None,
+    'company': 'your company',
+    'school': 'our shared alma mater',
+    'industry': 'this field',
+    'your_role': 'aspiring professional'
+}
+_fallback_fields = itemgetter('name', 'title', 'company', 'school', 'industry', 'your_role')
+
+def get_fallback_message(profile_data, classification=None):
+    """Improved fallback with audience-specific templates"""
+    if classification is None:
+        classification = _classify(profile_data)
+    _, kind = classification
+
+    # Pick the template from a stable hash of the profile URL so retries for
+    # the same person get the same message (str hash() varies per process)
+    seed = zlib.crc32(str(profile_data.get('profileUrl') or '').encode('utf-8'))
 
-    return template.format(**template_vars)
+    # Nulls are dropped so they get the defaults; numbers, lists or objects
+    # are coerced to str so every argument is hashable for the lru_cache.
+    # Only a missing title is still None here.
+    fields = tuple(
+        None if value is None else str(value)
+        for value in _fallback_fields(_FALLBACK_DEFAULTS | _present_fields(profile_data))
+    )
+    return _fallback_cached(*fields, kind, seed)
 
 # Testing function
 if __name__ == "__main__":
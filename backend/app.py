@@ -1,11 +1,20 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
 import os
+import sys
 from dotenv import load_dotenv
 import json
 import time
+import threading
+import queue
+import atexit
+from collections import deque
 import logging
 import traceback
+from celery import Celery
+from celery.result import AsyncResult
 import ai_generator
 
 # Configure logging
@@ -29,10 +38,48 @@ if os.getenv("OPENROUTER_API_KEY"):
 else:
     logger.warning("OpenRouter API key not found - will use fallback messages")
 
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson. Flask's request.json also parses through
+    the app's provider, so request bodies are decoded by orjson.loads straight
+    from bytes as well.
+    """
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Encode straight to bytes, skipping the str -> UTF-8 round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=self.option),
+            mimetype="application/json"
+        )
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)  # Enable CORS for all routes
 
+# Background task queue for message generation. When REDIS_URL is not set,
+# messages are generated inline on the request thread instead.
+REDIS_URL = os.getenv('REDIS_URL')
+celery = Celery('linkedin', broker=REDIS_URL, backend=REDIS_URL)
+
+@celery.task
+def generate_task(profile_data):
+    """Generate a message on a Celery worker"""
+    return ai_generator.generate_message(profile_data)
+
+@celery.task
+def generate_batch_task(profiles):
+    """Generate messages for several profiles on a Celery worker"""
+    return ai_generator.generate_messages_batch(profiles)
+
 # Error handler for all routes
 @app.errorhandler(Exception)
 def handle_exception(e):
@@ -46,32 +93,150 @@ def handle_exception(e):
 
 # In-memory storage (would be replaced with a database in production)
 profiles_data = {}
-connection_history = []
 
-# Rate limiting configuration
-MAX_REQUESTS_PER_HOUR = int(os.getenv('MAX_REQUESTS_PER_HOUR', 20))
-request_timestamps = []
+# Connection history is appended to a JSON-lines file by a background writer
+# so recording a connection only costs a queue put on the request path
+CONNECTION_HISTORY_PATH = os.getenv('CONNECTION_HISTORY_PATH', 'connection_history.jsonl')
+HISTORY_FLUSH_BATCH = 100
+HISTORY_FLUSH_INTERVAL = 1.0
+history_queue = queue.Queue()
+history_lock = threading.Lock()
 
-def check_rate_limit():
-    """Check if rate limit has been exceeded"""
-    global request_timestamps
-    
-    # Current time
-    current_time = time.time()
-    
-    # Remove timestamps older than 1 hour
-    one_hour_ago = current_time - 3600
-    request_timestamps = [ts for ts in request_timestamps if ts > one_hour_ago]
+def _count_history():
+    """Count records already persisted from previous runs"""
+    try:
+        with open(CONNECTION_HISTORY_PATH, 'rb') as f:
+            return sum(1 for line in f if line.strip())
+    except OSError:
+        return 0
+
+connections_count = _count_history()
+
+def _write_history(records):
+    """Append a batch of connection records to the history file"""
+    try:
+        with open(CONNECTION_HISTORY_PATH, 'ab') as f:
+            f.write(b''.join(orjson.dumps(r) + b'\n' for r in records))
+    except OSError as e:
+        logger.error(f"Failed to persist {len(records)} connection records: {e}")
+
+# Queued by the atexit hook to tell the writer to flush and stop
+_HISTORY_STOP = object()
+
+def _flush_history_loop():
+    """Batch queued records, writing every HISTORY_FLUSH_BATCH records or interval"""
+    stopping = False
+    while not stopping:
+        record = history_queue.get()
+        if record is _HISTORY_STOP:
+            break
+        records = [record]
+        deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+        while len(records) < HISTORY_FLUSH_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = history_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if record is _HISTORY_STOP:
+                stopping = True
+                break
+            records.append(record)
+        _write_history(records)
+
+history_writer = threading.Thread(target=_flush_history_loop, daemon=True)
+history_writer.start()
+
+@atexit.register
+def _stop_history_writer():
+    """Have the writer flush its pending batch and everything queued, then stop"""
+    history_queue.put(_HISTORY_STOP)
+    history_writer.join()
+
+def record_history(connection_record):
+    """Queue a connection record for persistence, returning the new total"""
+    global connections_count
     
-    # Check if at limit
-    return len(request_timestamps) >= MAX_REQUESTS_PER_HOUR
+    history_queue.put_nowait(connection_record)
+    with history_lock:
+        connections_count += 1
+        return connections_count
+
+# Secondary index: status -> profile URLs with that status. Inner dicts are
+# used as insertion-ordered sets so filtered results keep collection order.
+status_index = {}
+# Cached list(profiles_data.values()); None when profiles were added/replaced
+profiles_list = None
+# Guards profiles_data, status_index and profiles_list. Under gevent this is
+# patched to a cooperative lock, so updates can't interleave on a yield.
+profiles_lock = threading.Lock()
 
-def update_rate_limit():
-    """Update rate limiting counters"""
-    global request_timestamps
+def _index_status(profile_url, old_status, new_status):
+    """Move a profile URL between status buckets. Only string statuses are indexed."""
+    if isinstance(old_status, str):
+        bucket = status_index.get(old_status)
+        if bucket is not None:
+            bucket.pop(profile_url, None)
+            if not bucket:
+                del status_index[old_status]
+    if isinstance(new_status, str):
+        status_index.setdefault(new_status, {})[profile_url] = None
+
+# Low-cardinality profile fields shared by many profiles (same companies,
+# schools, ...), interned on ingestion so each distinct value is stored once
+INTERNED_PROFILE_FIELDS = ("company", "school", "industry", "title", "your_role")
+
+def intern_profile_fields(profile):
+    """Intern repeated string fields of a profile in place"""
+    for field in INTERNED_PROFILE_FIELDS:
+        value = profile.get(field)
+        if isinstance(value, str):
+            profile[field] = sys.intern(value)
+
+def store_profile(profile_url, profile):
+    """Store or replace a profile, keeping the status index in sync. Caller holds profiles_lock."""
+    global profiles_list
     
-    # Add current timestamp
-    request_timestamps.append(time.time())
+    old = profiles_data.get(profile_url)
+    profiles_data[profile_url] = profile
+    profiles_list = None
+    _index_status(profile_url, old.get('status') if old else None, profile.get('status'))
+
+def set_profile_status(profile_url, status):
+    """Update a stored profile's status, keeping the status index in sync. Caller holds profiles_lock."""
+    profile = profiles_data[profile_url]
+    _index_status(profile_url, profile.get('status'), status)
+    profile['status'] = status
+
+# Rate limiting configuration
+MAX_REQUESTS_PER_HOUR = int(os.getenv('MAX_REQUESTS_PER_HOUR', 20))
+RATE_LIMIT_WINDOW_NS = 3600 * 1_000_000_000
+# Monotonic integer timestamps: unaffected by wall-clock changes and compared
+# as ints rather than floats
+request_timestamps = deque()
+rate_limit_lock = threading.Lock()
+
+def check_and_update_rate_limit():
+    """
+    Check if rate limit has been exceeded and, if not, count this request.
+    Both steps happen under one lock so concurrent requests can't both slip
+    in under the limit.
+    """
+    now = time.monotonic_ns()
+    # Drop timestamps older than 1 hour from the front of the window
+    cutoff = now - RATE_LIMIT_WINDOW_NS
+    with rate_limit_lock:
+        while request_timestamps and request_timestamps[0] <= cutoff:
+            request_timestamps.popleft()
+        
+        # Check if at limit
+        if len(request_timestamps) >= MAX_REQUESTS_PER_HOUR:
+            return True
+        
+        request_timestamps.append(now)
+        return False
 
 @app.route('/')
 def index():
@@ -88,7 +253,7 @@ def status():
     return jsonify({
         "status": "online",
         "profiles_collected": len(profiles_data),
-        "connections_sent": len(connection_history),
+        "connections_sent": connections_count,
         "timestamp": time.time()
     })
 
@@ -100,34 +265,60 @@ def collect_profiles():
     
     data = request.json
     
-    if not data or 'profiles' not in data:
+    if not isinstance(data, dict) or not isinstance(data.get('profiles'), list):
         return jsonify({"error": "No profiles provided"}), 400
     
     # Process each profile
-    for profile in data['profiles']:
-        if 'profileUrl' in profile:
-            # Store profile data using URL as unique key
-            profiles_data[profile['profileUrl']] = profile
+    with profiles_lock:
+        for profile in data['profiles']:
+            if isinstance(profile, dict) and 'profileUrl' in profile:
+                # Store profile data using URL as unique key
+                intern_profile_fields(profile)
+                store_profile(profile['profileUrl'], profile)
+        profiles_count = len(profiles_data)
     
     return jsonify({
         "success": True,
-        "profiles_count": len(profiles_data),
+        "profiles_count": profiles_count,
         "message": f"Stored {len(data['profiles'])} profiles"
     })
 
+# Profiles encoded per chunk when streaming get-profiles
+STREAM_CHUNK_SIZE = 256
+
+def stream_profiles(profiles):
+    """
+    Yield {"profiles": [...]} as JSON a chunk of profiles at a time, so the
+    full encoded payload is never held in memory at once. Callers pass a
+    list snapshot so concurrent inserts can't disturb iteration mid-response.
+    """
+    yield b'{"profiles":['
+    for start in range(0, len(profiles), STREAM_CHUNK_SIZE):
+        chunk = b','.join(orjson.dumps(p, option=OrjsonProvider.option)
+                          for p in profiles[start:start + STREAM_CHUNK_SIZE])
+        yield chunk if start == 0 else b',' + chunk
+    yield b']}'
+
 @app.route('/api/get-profiles', methods=['GET'])
 def get_profiles():
     """Get collected profiles"""
+    global profiles_list
+    
     # Optional filtering by status
     status_filter = request.args.get('status')
     
     if status_filter:
-        filtered_profiles = [p for p in profiles_data.values() 
-                             if p.get('status') == status_filter]
-        return jsonify({"profiles": filtered_profiles})
+        with profiles_lock:
+            filtered_profiles = [profiles_data[url] 
+                                 for url in status_index.get(status_filter, ())]
+        return Response(stream_profiles(filtered_profiles), mimetype="application/json")
     
     # Return all profiles if no filter
-    return jsonify({"profiles": list(profiles_data.values())})
+    with profiles_lock:
+        if profiles_list is None:
+            profiles_list = list(profiles_data.values())
+        snapshot = profiles_list
+    return Response(stream_profiles(snapshot), mimetype="application/json")
 
 @app.route('/api/record-connection', methods=['POST'])
 def record_connection():
@@ -137,20 +328,17 @@ def record_connection():
     
     data = request.json
     
-    if not data or 'profileUrl' not in data:
+    if not isinstance(data, dict) or 'profileUrl' not in data:
         return jsonify({"error": "No profile URL provided"}), 400
     
     # Check rate limiting
-    if check_rate_limit():
+    if check_and_update_rate_limit():
         logger.warning("Rate limit exceeded")
         return jsonify({
             "error": "Rate limit exceeded",
             "message": f"Maximum of {MAX_REQUESTS_PER_HOUR} connections per hour allowed"
         }), 429
     
-    # Update rate limiting counter
-    update_rate_limit()
-    
     profile_url = data['profileUrl']
     logger.info(f"Recording connection for profile: {profile_url}")
     
@@ -161,16 +349,17 @@ def record_connection():
         "messageUsed": data.get('messageUsed', None)
     }
     
-    connection_history.append(connection_record)
+    total_connections = record_history(connection_record)
     
     # Update profile status if it exists in our data
-    if profile_url in profiles_data:
-        profiles_data[profile_url]['status'] = 'connected'
-        profiles_data[profile_url]['connectionTimestamp'] = connection_record['timestamp']
+    with profiles_lock:
+        if profile_url in profiles_data:
+            set_profile_status(profile_url, 'connected')
+            profiles_data[profile_url]['connectionTimestamp'] = connection_record['timestamp']
     
     return jsonify({
         "success": True,
-        "connections_count": len(connection_history),
+        "connections_count": total_connections,
         "message": "Connection recorded successfully"
     })
 
@@ -182,10 +371,15 @@ def generate_message():
     
     data = request.json
     
-    if not data or 'profileData' not in data:
+    if not isinstance(data, dict) or not isinstance(data.get('profileData'), dict):
         return jsonify({"error": "No profile data provided"}), 400
     
     profile_data = data['profileData']
+
+    # Hand off to a worker so the DeepSeek round-trip doesn't hold this thread
+    if REDIS_URL:
+        task = generate_task.delay(profile_data)
+        return jsonify({"task_id": task.id}), 202
     
     # Call the AI generator
     try:
@@ -201,7 +395,69 @@ def generate_message():
             "message": "I came across your profile and would love to connect!"  # Fallback message
         }), 500
 
+@app.route('/api/generate-messages', methods=['POST'])
+def generate_messages():
+    """Generate personalized messages for several profiles in one AI call"""
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
+    
+    data = request.json
+    
+    if not isinstance(data, dict) or not isinstance(data.get('profiles'), list):
+        return jsonify({"error": "No profiles provided"}), 400
+    
+    profiles = data['profiles']
+
+    if not all(isinstance(p, dict) for p in profiles):
+        return jsonify({"error": "Each profile must be an object"}), 400
+
+    if REDIS_URL:
+        task = generate_batch_task.delay(profiles)
+        return jsonify({"task_id": task.id}), 202
+    
+    try:
+        messages = ai_generator.generate_messages_batch(profiles)
+        return jsonify({
+            "success": True,
+            "messages": messages
+        })
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/generate-message/<task_id>', methods=['GET'])
+def generate_message_result(task_id):
+    """Poll the result of a queued message generation task"""
+    # Without Redis there is no result backend and no task was ever queued
+    if not REDIS_URL:
+        return jsonify({"error": "Task queue is not configured"}), 404
+
+    result = AsyncResult(task_id, app=celery)
+
+    if result.state == 'SUCCESS':
+        # Batch tasks return a {url: message} map, single tasks a string
+        key = "messages" if isinstance(result.result, dict) else "message"
+        return jsonify({
+            "success": True,
+            "state": result.state,
+            key: result.result
+        })
+
+    if result.state == 'FAILURE':
+        return jsonify({
+            "success": False,
+            "state": result.state,
+            "error": str(result.result),
+            "message": "I came across your profile and would love to connect!"  # Fallback message
+        }), 500
+
+    return jsonify({"state": result.state}), 202
+
 if __name__ == '__main__':
+    # Development server only. In production run under gunicorn with a gevent
+    # worker (settings in gunicorn.conf.py): gunicorn app:app
     # Get port from environment variable or use 5000 as default
     port = int(os.environ.get('PORT', 5000))
     # Run the app
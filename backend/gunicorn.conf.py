@@ -0,0 +1,24 @@
+# Gunicorn settings for production, picked up automatically when running
+# `gunicorn app:app` from this directory. Any setting can be overridden with
+# GUNICORN_CMD_ARGS, e.g. GUNICORN_CMD_ARGS="--timeout=60".
+#
+# A gevent worker makes blocking socket I/O (the DeepSeek API calls) cooperative,
+# so it can keep many message generations in flight instead of each
+# one blocking the process for the length of the API round-trip.
+import os
+
+# Patch sockets, threading, etc. before the app (and requests) is imported
+from gevent import monkey
+monkey.patch_all()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = "gevent"
+# One worker: profiles, the status index, the rate-limit window, the
+# connection count and the message cache all live in process memory, so
+# several workers would each see different data and each allow a full
+# MAX_REQUESTS_PER_HOUR. gevent already gives concurrency within the worker.
+# Only raise this once that state moves to a shared store such as Redis.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_connections = 200
+# Generation can take a while with retries and backoff
+timeout = 120
@@ -0,0 +1,179 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+import requests
+import sqlite_vec
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Semantic cache of generated messages. Profiles that differ only by name
+# (same title, company, school, ...) get effectively the same message, so
+# messages are stored as templates with the recipient's name swapped for a
+# placeholder and looked up by embedding similarity. Enabled when a local
+# Ollama server is configured to compute embeddings.
+OLLAMA_URL = os.getenv("OLLAMA_URL")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", 768))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.db")
+SIMILARITY_THRESHOLD = 0.95
+TTL_SECONDS = 30 * 24 * 3600
+
+enabled = bool(OLLAMA_URL)
+
+_session = requests.Session()
+_conn = None
+_lock = threading.Lock()
+
+def _connect():
+    """Open the cache database on first use. Caller holds _lock."""
+    global _conn
+
+    if _conn is None:
+        conn = sqlite3.connect(SEMANTIC_CACHE_PATH, check_same_thread=False)
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_vectors USING vec0(
+                workspace text partition key,
+                embedding float[{EMBEDDING_DIM}] distance_metric=cosine,
+                created_at integer,
+                +template text
+            )""")
+        # Drop entries past their TTL
+        conn.execute("DELETE FROM message_vectors WHERE created_at < ?",
+                     (int(time.time()) - TTL_SECONDS,))
+        conn.commit()
+        _conn = conn
+    return _conn
+
+def canonical_profile(profile_data):
+    """Everything that shapes the message except the recipient's name"""
+    values = (profile_data.get(field) for field in
+              ('title', 'company', 'industry', 'school', 'your_role'))
+    return "|".join('' if value is None else str(value) for value in values)
+
+def _workspace(profile_data):
+    """Cache namespace, so different users never share messages"""
+    return profile_data.get('workspace') or 'default'
+
+def _embed(texts):
+    """Embed several texts in one call to the local Ollama server"""
+    response = _session.post(
+        f"{OLLAMA_URL}/api/embed",
+        json={"model": EMBEDDING_MODEL, "input": texts},
+        timeout=10
+    )
+    response.raise_for_status()
+    return response.json()['embeddings']
+
+def _whole_word(text):
+    """Regex matching text not embedded in a longer word"""
+    return r'(?<!\w)%s(?!\w)' % re.escape(text)
+
+def _starts_sentence(text, pos):
+    """Whether pos is the first word of a sentence in text"""
+    before = text[:pos].rstrip(' \t\n"\'(')
+    return not before or before[-1] in '.!?'
+
+def _to_template(message, name):
+    """
+    Turn a generated message into a format string with name placeholders.
+    Returns None whenever the name can't be swapped out safely: part of it is
+    still left in the message in any casing (a surname after a title, a
+    suffix, "John" for "JOHN SMITH", ...), or the first name shows up more
+    than once or starts a sentence, where it may just be a word ("Will you
+    be open..."). Serving those to someone else could leak the name.
+    """
+    template = message.replace('{', '{{').replace('}', '}}')
+    if not isinstance(name, str) or not name.strip():
+        return template
+
+    name = name.strip()
+    template = re.sub(_whole_word(name), '{name}', template)
+
+    first_name = name.split()[0]
+    matches = list(re.finditer(_whole_word(first_name), template, re.IGNORECASE))
+    if len(matches) > 1:
+        return None
+    if matches:
+        match = matches[0]
+        if match.group() != first_name or _starts_sentence(template, match.start()):
+            return None
+        template = template[:match.start()] + '{first_name}' + template[match.end():]
+
+    # Check what's left, ignoring the placeholders themselves
+    remainder = template.replace('{name}', '').replace('{first_name}', '')
+    for token in re.findall(r'\w+', name):
+        if re.search(_whole_word(token), remainder, re.IGNORECASE):
+            return None
+    return template
+
+def _render(template, name):
+    """Fill a stored template for a new recipient"""
+    if not isinstance(name, str) or not name.strip():
+        name = 'there'
+    return template.format(name=name, first_name=name.split()[0])
+
+def lookup_many(profiles):
+    """
+    Return a cached message for each profile, or None where there is no
+    stored message similar enough. Any failure counts as a miss.
+    """
+    if not enabled or not profiles:
+        return [None] * len(profiles)
+
+    try:
+        embeddings = _embed([canonical_profile(p) for p in profiles])
+        cutoff = int(time.time()) - TTL_SECONDS
+        results = []
+        with _lock:
+            conn = _connect()
+            for profile_data, embedding in zip(profiles, embeddings):
+                row = conn.execute("""
+                    SELECT template, distance FROM message_vectors
+                    WHERE embedding MATCH ? AND k = 1
+                      AND workspace = ? AND created_at > ?""",
+                    (sqlite_vec.serialize_float32(embedding),
+                     _workspace(profile_data), cutoff)).fetchone()
+                # Cosine distance is 1 - cosine similarity
+                if row is not None and 1 - row[1] >= SIMILARITY_THRESHOLD:
+                    results.append(_render(row[0], profile_data.get('name')))
+                else:
+                    results.append(None)
+        return results
+    except Exception as e:
+        logger.warning(f"Semantic cache lookup failed: {e}")
+        return [None] * len(profiles)
+
+def store_many(entries):
+    """Store (profile_data, message) pairs for later similarity lookups"""
+    if not enabled or not entries:
+        return
+
+    try:
+        embeddings = _embed([canonical_profile(p) for p, _ in entries])
+        now = int(time.time())
+        with _lock:
+            rows = []
+            for (profile_data, message), embedding in zip(entries, embeddings):
+                template = _to_template(message, profile_data.get('name'))
+                if template is not None:
+                    rows.append((_workspace(profile_data),
+                                 sqlite_vec.serialize_float32(embedding), now, template))
+            conn = _connect()
+            conn.executemany(
+                "INSERT INTO message_vectors(workspace, embedding, created_at, template) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+    except Exception as e:
+        logger.warning(f"Semantic cache store failed: {e}")
@@ -0,0 +1,48 @@
+import unittest
+
+import semantic_cache
+
+
+class ToTemplateTest(unittest.TestCase):
+    """Name placeholders must never let a previous recipient's name leak"""
+
+    def test_full_name_is_replaced(self):
+        template = semantic_cache._to_template("Hi Grant Lee, thanks for sharing.", "Grant Lee")
+        self.assertEqual(template, "Hi {name}, thanks for sharing.")
+        self.assertEqual(semantic_cache._render(template, "Bob Ray"), "Hi Bob Ray, thanks for sharing.")
+
+    def test_full_name_with_suffix_is_replaced(self):
+        template = semantic_cache._to_template("Hi Ann Lee Jr., great work.", "Ann Lee Jr.")
+        self.assertEqual(template, "Hi {name}, great work.")
+
+    def test_first_name_is_replaced(self):
+        template = semantic_cache._to_template("Hi Will, I'd love to connect.", "Will Smith")
+        self.assertEqual(template, "Hi {first_name}, I'd love to connect.")
+        self.assertEqual(semantic_cache._render(template, "Bob Ray"), "Hi Bob, I'd love to connect.")
+
+    def test_braces_in_message_survive(self):
+        template = semantic_cache._to_template("Your {work} is great.", "Ann Lee")
+        self.assertEqual(semantic_cache._render(template, "Bob Ray"), "Your {work} is great.")
+
+    def test_mixed_case_names_are_rejected(self):
+        self.assertIsNone(semantic_cache._to_template("Hi John, great work at Acme.", "JOHN SMITH"))
+        self.assertIsNone(semantic_cache._to_template("Hi john, great work at Acme.", "John Smith"))
+        self.assertIsNone(semantic_cache._to_template("Hi Ann, loved your Smith talk.", "ann smith"))
+
+    def test_leftover_surname_is_rejected(self):
+        self.assertIsNone(semantic_cache._to_template("Hello Ms. Lee, nice to meet you.", "Ann Lee"))
+        self.assertIsNone(semantic_cache._to_template("Dr. Lee's lab is impressive.", "Ann Lee"))
+
+    def test_common_word_first_names_are_rejected(self):
+        self.assertIsNone(semantic_cache._to_template("Will you be open to connecting?", "Will Smith"))
+        self.assertIsNone(semantic_cache._to_template("Hi Will, will you share some insights?", "Will Smith"))
+        self.assertIsNone(semantic_cache._to_template("Hi May, May I ask about your role?", "May Chen"))
+        self.assertIsNone(semantic_cache._to_template("I'd welcome a grant of your time, Grant.", "Grant Lee"))
+
+    def test_message_without_name_is_kept(self):
+        self.assertEqual(semantic_cache._to_template("Would love to connect.", "Ann Lee"), "Would love to connect.")
+        self.assertEqual(semantic_cache._to_template("Would love to connect.", None), "Would love to connect.")
+
+
+if __name__ == "__main__":
+    unittest.main()